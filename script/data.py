@@ -4,10 +4,11 @@ import csv
 import numpy as np
 from nltk.tokenize.toktok import ToktokTokenizer
 from utils import compute_overlap
-from math import ceil
-from typing import List
+from typing import List, Tuple
 from collections import namedtuple
 from utils import pad_labels
+from vocab import Vocab
+from torch.nn.utils.rnn import pad_sequence
 import json
 import h5py
 
@@ -16,15 +17,28 @@ np.random.seed(42)
 
 
 TOKENIZER = ToktokTokenizer()
-Caption = namedtuple('Caption', ['video_id', 'start_time', 'end_time', 'sent'])
+Caption = namedtuple('Caption', ['video_id', 'start_time', 'end_time', 'sent', 'embed'])
+
+
+def embed_sent(sent: List[str], vocab: Vocab, word_vectors: np.ndarray):
+    """Looks up the (frozen) word vectors of a tokenized sentence once, so that
+    the training loop does not need to do it at every iteration
+    :param sent: list of words
+    :param vocab: vocabulary built upon the words of the word vectors
+    :param word_vectors: word vectors with shape (vocab_size, embed_size)
+    :returns a np.ndarray with shape (len(sent), embed_size)
+    """
+    return word_vectors[vocab.sent2ids(sent)].astype(np.float32, copy=False)
 
 
 class TACoS(torch.utils.data.Dataset):
     def __init__(self, textual_data_path: str, visual_data_path: str, delta: int, K: int, 
-                 threshold: float, val_ratio=0.25, test_ratio=0.25):
+                 threshold: float, vocab: Vocab, word_vectors: np.ndarray, val_ratio=0.25, test_ratio=0.25):
         """
         :param textual_data_path: directory containing the annotations
         :param visual_data_path: directory containing the features extracted from videos
+        :param vocab: vocabulary used to look up the words of the captions
+        :param word_vectors: word vectors with shape (vocab_size, embed_size)
         :param num_time_scales: K in the paper
         :param delta: ẟ in the paper
         :param threshold: θ in the paper
@@ -36,6 +50,7 @@ class TACoS(torch.utils.data.Dataset):
         self.textual_data_path = textual_data_path
         self.visual_data_path = visual_data_path
         self.threshold = threshold
+        self.word_embed_size = word_vectors.shape[1]
         self.fps = 30  # number of frames per second for TACoS dataset
         self.sample_rate = self.fps * 5  # note that we sample one frame every five seconds
 
@@ -53,7 +68,8 @@ class TACoS(torch.utils.data.Dataset):
                     sents = set([sent for sent in row[6:] if len(sent) > 0])
                     sents = [TOKENIZER.tokenize(sent.lower()) for sent in sents]
                     self.captions += [Caption(video_id=video_id, start_time=start_frame / self.fps, 
-                                              end_time=end_frame / self.fps, sent=sent) 
+                                              end_time=end_frame / self.fps, sent=sent,
+                                              embed=embed_sent(sent, vocab, word_vectors))
                                       for sent in sents]
 
         index_array = list(range(len(self.captions)))
@@ -69,7 +85,7 @@ class TACoS(torch.utils.data.Dataset):
         self.test_captions = [self.captions[idx] for idx in self.test_indices]
         
         self.train_indices = index_array[val_size+test_size:]
-        self.test_captions = [self.captions[idx] for idx in self.train_indices]
+        self.train_captions = [self.captions[idx] for idx in self.train_indices]
         
         visual_feature, _, _ = self[0]
         self.visual_feature_size = visual_feature.shape[1]
@@ -115,7 +131,7 @@ class TACoS(torch.utils.data.Dataset):
         s = self.captions[self.train_indices[item]]
         file = s.video_id + '_features.pt'
         path = os.path.join(self.visual_data_path, file)
-        visual_feature = torch.load(path)
+        visual_feature = torch.load(path, map_location='cpu')
         label = self._generate_labels([visual_feature], [s])[0]
         return visual_feature, s, label
 
@@ -130,49 +146,16 @@ class TACoS(torch.utils.data.Dataset):
             video_id = t.video_id
             file = video_id + '_features.pt'
             path = os.path.join(self.visual_data_path, file)
-            visual_feature = torch.load(path)
+            visual_feature = torch.load(path, map_location='cpu')
             visual_data.append(visual_feature)
 
         return visual_data
 
- 
-    def data_iter(self, batch_size: int, which_set: str):
-        """Iterates over the train, validation, or the test set
-        :param batch_size
-        :param which_set: specifies the part of the data to iterate over as a 
-        str ('train', 'val', or 'test')
-        :return: batches of data
-        Note that ground truth labels are just used during training procedure.
-        """
-        index_array = None
-        if which_set == 'train':
-            index_array = self.train_indices
-        elif which_set == 'val':
-            index_array = self.val_indices
-        elif which_set == 'test':
-            index_array = self.test_indices
-
-        batch_num = ceil(len(index_array) / batch_size)
-        
-        for i in range(batch_num):
-            indices = index_array[i * batch_size: (i + 1) * batch_size]
-            batch_captions = [self.captions[idx] for idx in indices]
-            batch_captions = sorted(batch_captions, key=lambda s: len(s.sent), reverse=True)
-
-            visual_data = self._load_visual_data(batch_captions)
-
-            if which_set == 'train':
-                labels = self._generate_labels(visual_data=visual_data, captions=batch_captions)
-                captions_sents = [s.sent for s in batch_captions]
-                yield captions_sents, visual_data, labels
-            else:
-                yield batch_captions, visual_data
-
     
 class ActivityNet(torch.utils.data.Dataset):
     """ActivityNet Captions dataset"""
     def __init__(self, textual_data_path: str, visual_data_path: str, K: int, delta: int, 
-                 threshold: float):
+                 threshold: float, vocab: Vocab, word_vectors: np.ndarray):
         super(ActivityNet, self).__init__()
         
         self.name = 'ActivityNet'
@@ -181,6 +164,7 @@ class ActivityNet(torch.utils.data.Dataset):
         self.textual_data_path = textual_data_path
         self.visual_data_path = visual_data_path
         self.threshold = threshold
+        self.word_embed_size = word_vectors.shape[1]
         self.fps = 30  # number of frames per second in videos
         
         '''
@@ -201,7 +185,8 @@ class ActivityNet(torch.utils.data.Dataset):
                 sents = value['sentences']
                 sents = [TOKENIZER.tokenize(sent.lower()) for sent in sents]
                 self.train_captions += [Caption(video_id=key, start_time=time_stamp[0], 
-                                                end_time=time_stamp[1], sent=sent) 
+                                                end_time=time_stamp[1], sent=sent,
+                                                embed=embed_sent(sent, vocab, word_vectors))
                                         for time_stamp, sent in zip(time_stamps, sents)]
 
         np.random.shuffle(self.train_captions)
@@ -217,21 +202,43 @@ class ActivityNet(torch.utils.data.Dataset):
                 sents = value['sentences']
                 sents = [TOKENIZER.tokenize(sent.lower()) for sent in sents]
                 self.val_captions += [Caption(video_id=key, start_time=time_stamp[0], 
-                                              end_time=time_stamp[1], sent=sent) 
+                                              end_time=time_stamp[1], sent=sent,
+                                              embed=embed_sent(sent, vocab, word_vectors))
                                       for time_stamp, sent in zip(time_stamps, sents)]
         
 #         print('number of val instances', len(self.val_captions))
         
         self.test_captions = []
         
-        self.visual_features = h5py.File(os.path.join(visual_data_path, 
-                                                      'sub_activitynet_v1-3.c3d.hdf5'), 'r')
+        self._visual_features = None
+        self._visual_features_pid = None
         
         visual_feature, _, _ = self[0]
         self.visual_feature_size = visual_feature.shape[1]
     
     def __len__(self):
         return len(self.train_captions)
+
+    @property
+    def visual_features(self):
+        """The hdf5 file containing the C3D features. It is opened once per process, since
+        an h5py file handle can not be shared with the workers of a DataLoader
+        """
+        if self._visual_features_pid != os.getpid():
+            self._visual_features = h5py.File(os.path.join(self.visual_data_path, 
+                                                           'sub_activitynet_v1-3.c3d.hdf5'), 'r')
+            self._visual_features_pid = os.getpid()
+
+        return self._visual_features
+
+    def __getstate__(self):
+        """Drops the open hdf5 file when the dataset is pickled (e.g. for DataLoader workers started
+        with spawn or forkserver), the file is then reopened by the visual_features property
+        """
+        state = self.__dict__.copy()
+        state['_visual_features'] = None
+        state['_visual_features_pid'] = None
+        return state
     
     def __getitem__(self, item):
         """
@@ -285,34 +292,90 @@ class ActivityNet(torch.utils.data.Dataset):
             visual_data.append(visual_feature)
 
         return visual_data
-    
-    def data_iter(self, batch_size: int, which_set: str):
-        """Iterates over the train, validation, or the test set
-        :param batch_size
-        :param which_set: specifies the part of the data to iterate over as a 
-        str ('train', 'val', or 'test')
-        return: batches of data
-        Note that ground truth labels are just used during training procedure.
+
+
+class CaptionSet(torch.utils.data.Dataset):
+    """The train, validation, or the test set of TACoS or ActivityNet, to be iterated
+    over with a torch.utils.data.DataLoader (see make_data_loader). The captions are stored
+    as separate arrays (embeddings, start and end times) which are indexed a whole batch at a time
+    """
+    def __init__(self, dataset, which_set: str):
         """
-        if which_set == 'train':
-            data = self.train_captions
-        elif which_set == 'val':
-            data = self.val_captions
-        
-        indices = list(range(len(data)))
-        batch_num = ceil(len(data) / batch_size)
-        
-        for i in range(batch_num):
-            batch_indices = indices[i * batch_size: (i + 1) * batch_size]
-            batch_captions = [data[idx] for idx in batch_indices]
-            batch_captions = sorted(batch_captions, key=lambda s: len(s.sent), reverse=True)
-            
-            visual_data = self._load_visual_data(batch_captions)  # a list of torch.Tensors
-
-            if which_set == 'train':
-                labels = self._generate_labels(visual_data=visual_data, captions=batch_captions)
-                captions_sents = [s.sent for s in batch_captions]   
-                yield captions_sents, visual_data, labels
-            else:
-                yield batch_captions, visual_data
-            
+        :param dataset: an instance of TACoS or ActivityNet
+        :param which_set: specifies the part of the data as a str ('train', 'val', or 'test')
+        Note that ground truth labels are just generated for the train set.
+        """
+        super(CaptionSet, self).__init__()
+        self.dataset = dataset
+        self.which_set = which_set
+        self.captions = getattr(dataset, which_set + '_captions')
+
+        self.embeds = [torch.from_numpy(s.embed) for s in self.captions]
+        self.start_times = torch.tensor([s.start_time for s in self.captions], dtype=torch.float32)
+        self.end_times = torch.tensor([s.end_time for s in self.captions], dtype=torch.float32)
+
+    def __len__(self):
+        return len(self.captions)
+
+    def __getitem__(self, indices: List[int]):
+        """
+        :param indices: The indices of the instances of a batch
+        :returns the embedded captions, the features of the corresponding videos, the ground-truth
+        labels (None for validation and test) and the start and end times of the captions
+        as tensors with shape (n_batch,)
+        """
+        captions = [self.captions[idx] for idx in indices]
+        visual_data = self.dataset._load_visual_data(captions)
+        labels = None
+        if self.which_set == 'train':
+            labels = self.dataset._generate_labels(visual_data=visual_data, captions=captions)
+
+        return ([self.embeds[idx] for idx in indices], visual_data, labels,
+                self.start_times[indices], self.end_times[indices])
+
+
+def collate(batch: Tuple):
+    """Pads the embedded captions of a batch returned by CaptionSet.__getitem__
+    :param batch: a batch returned by CaptionSet.__getitem__
+    :returns the embedded sentences as a tensor with shape (n_batch, N, embed_size), the lengths
+    of the sentences, the list of the visual features, the labels with shape (n_batch, T, K) (or None)
+    and the start and end times of the captions as tensors with shape (n_batch,)
+    """
+    embeds, visual_data, labels, start_times, end_times = batch
+
+    lengths_t = [e.shape[0] for e in embeds]
+    textual_input = pad_sequence(embeds, batch_first=True)
+
+    return textual_input, lengths_t, visual_data, labels, start_times, end_times
+
+
+def make_data_loader(dataset, batch_size: int, which_set: str, num_workers: int = 0, pin_memory: bool = False,
+                     distributed: bool = False):
+    """Builds a DataLoader over the train, validation, or the test set, so that loading the videos
+    and padding the batches is done by worker processes while the model is training
+    :param dataset: an instance of TACoS or ActivityNet
+    :param batch_size
+    :param which_set: specifies the part of the data to iterate over as a 
+    str ('train', 'val', or 'test')
+    :param num_workers: number of worker processes, 0 loads the batches in the main process
+    :param pin_memory: whether to put the tensors of the batches in page-locked memory,
+    so that they can be copied asynchronously to the GPU
+    :param distributed: whether to split the data between the processes of distributed training,
+    sampler.sampler.set_epoch has then to be called at the beginning of every epoch
+    :returns a torch.utils.data.DataLoader yielding batches as returned by collate
+    """
+    caption_set = CaptionSet(dataset, which_set)
+    shuffle = which_set == 'train'
+    if distributed:
+        sampler = torch.utils.data.distributed.DistributedSampler(caption_set, shuffle=shuffle)
+    elif shuffle:
+        sampler = torch.utils.data.RandomSampler(caption_set)
+    else:
+        sampler = torch.utils.data.SequentialSampler(caption_set)
+
+    # the batches of indices are given to CaptionSet.__getitem__ as a whole, hence batch_size=None
+    batch_sampler = torch.utils.data.BatchSampler(sampler, batch_size=batch_size, drop_last=False)
+
+    return torch.utils.data.DataLoader(caption_set, batch_size=None, sampler=batch_sampler,
+                                       num_workers=num_workers, pin_memory=pin_memory,
+                                       persistent_workers=num_workers > 0, collate_fn=collate)
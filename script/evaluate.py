@@ -15,48 +15,45 @@ Options:
     --batch-size=<int>                      batch size [default: 32]
     --model-path=<file>                     model load path [default: model.bin]
     --top-n-eval=<int>                      Parameter N in R@N, IOU=θ evaluation metric [default: 1]
+    --num-workers=<int>                     number of processes loading the batches [default: 4]
 """
 
 import torch
-import torch.nn as nn
 from models.tgn import TGN
 from docopt import docopt
 from vocab import Vocab
 from utils import load_word_vectors
-from utils import top_n_iou
+from utils import top_n_iou, Prefetcher
 import sys
-from data import TACoS, ActivityNet
+from data import TACoS, ActivityNet, make_data_loader
 from tqdm import tqdm
-from math import ceil
 
 
-def evaluate(model: TGN, dataset, embedding: nn.Embedding, K, threshold: float, delta: int, batch_size: int):
+def evaluate(model: TGN, dataset, K, threshold: float, delta: int, batch_size: int):
     batch_size = int(args['--batch-size'])
+    data_loader = make_data_loader(dataset, batch_size, 'test', num_workers=int(args['--num-workers']),
+                                   pin_memory=device.type == 'cuda')
 
     with torch.no_grad():
         cum_score = cum_samples = 0
 
-        pbar = tqdm(total=ceil(len(dataset.val_captions) / batch_size))
+        pbar = tqdm(total=len(data_loader))
 
-        for textual_data, visual_data in iter(dataset.data_iter(batch_size, 'test')):
-            cum_samples += len(textual_data)
-            lengths_t = [len(t) for t in textual_data]
-            sents = [t.sent for t in textual_data]
-            textual_data_tensor = vocab.to_input_tensor(sents, device=device)  # tensor with shape (n_batch, N)
-            textual_data_embed_tensor = embedding(textual_data_tensor)  # tensor with shape (n_batch, N, embed_size)
+        for batch in Prefetcher(data_loader, device):
+            # textual_input is a tensor with shape (n_batch, N, embed_size)
+            textual_input, lengths_t, visual_data, _, gold_start_times, gold_end_times = batch
+            cum_samples += len(lengths_t)
 
-            probs, mask = model(visual_data, textual_data_embed_tensor, lengths_t)  # Tensors with shape (n_batch, T, K)
+            logits, mask = model(visual_data, textual_input, lengths_t)  # Tensors with shape (n_batch, T, K)
+            probs = torch.sigmoid(logits) * mask
 
-            gold_start_times = [t.start_time for t in textual_data]
-            gold_end_times = [t.end_time for t in textual_data]
-
-            score = top_n_iou(probs*mask, gold_start_times, gold_end_times, args, dataset.fps, dataset.sample_rate)
+            score = top_n_iou(probs, gold_start_times, gold_end_times, args, dataset.fps, dataset.sample_rate)
             cum_score += score
             pbar.update()
 
         pbar.close()
     
-    print('test score %.2f' % (cum_score / cum_samples))
+    print('test score %.2f' % (float(cum_score) / cum_samples))
 
 
 if __name__ == '__main__':
@@ -75,10 +72,10 @@ if __name__ == '__main__':
 
     if args['tacos']:
         dataset = TACoS(textual_data_path=textual_data_path, visual_data_path=visual_data_path, 
-                        K=K, delta=delta, threshold=threshold)
+                        K=K, delta=delta, threshold=threshold, vocab=vocab, word_vectors=word_vectors)
     elif args['acnet']:
         dataset = ActivityNet(textual_data_path=textual_data_path, visual_data_path=visual_data_path, 
-                              K=K, delta=delta, threshold=threshold)
+                              K=K, delta=delta, threshold=threshold, vocab=vocab, word_vectors=word_vectors)
     
     device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
     print('use device: %s' % device, file=sys.stderr)
@@ -87,8 +84,4 @@ if __name__ == '__main__':
     model = TGN.load(args['--model-path'])
     model.to(device)
     
-    embedding = nn.Embedding(len(vocab), word_vectors.shape[1], padding_idx=vocab.word2id['<pad>'])
-    embedding.weight = nn.Parameter(data=torch.from_numpy(word_vectors).to(torch.float32), requires_grad=False)
-    embedding.to(device)
-    
-    evaluate(model, dataset, embedding, K, threshold, delta, batch_size)
\ No newline at end of file
+    evaluate(model, dataset, K, threshold, delta, batch_size)
\ No newline at end of file
@@ -11,8 +11,9 @@ class Grounder(nn.Module):
     def forward(self, input: torch.Tensor):
         """
         :param input: Output of iLSTM with the shape (batch_size, T, hidden_size_iLSTM)
-        :return C_T: torch.Tensor with shape (n_batch, T, num_time_scales)
+        :return C_T: logits of the grounding scores as a torch.Tensor with shape (n_batch, T, num_time_scales),
+        the sigmoid is left to the loss (or to the evaluation) for numerical stability
         """
-        C_t = torch.sigmoid(self.projection(input))
+        C_t = self.projection(input)
 
         return C_t
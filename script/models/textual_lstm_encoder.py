@@ -20,11 +20,12 @@ class TextualLSTMEncoder(nn.Module):
     def forward(self, input: torch.Tensor, lengths: List[int]):
         """
         :param input: A batch of sentences with shape (n_batch, N, embed_size)
-        :param lengths: lengths of the input sentences
+        :param lengths: lengths of the input sentences (in any order)
         :return: the encoded representation of the sentences
         """
         x = input.permute(1, 0, 2)  # shape (N, n_batch, embed_size)
-        x = pack(x, lengths)
+        # the LSTM only runs over the actual words, the batch order is restored by unpack
+        x = pack(x, lengths, enforce_sorted=False)
         enc_hiddens, (_, _) = self.encoder(x)
         enc_hiddens, _ = unpack(enc_hiddens)  # shape of enc_hiddens is (N, n_batch, hidden_size)
 
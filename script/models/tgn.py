@@ -1,5 +1,6 @@
 import torch
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
 from models.interactor import Interactor
 from models.visual_lstm_encoder import VisualLSTMEncoder
 from models.textual_lstm_encoder import TextualLSTMEncoder
@@ -11,7 +12,11 @@ import sys
 
 class TGN(nn.Module):
     def __init__(self, word_embed_size: int, hidden_size_textual: int, hidden_size_visual: int,
-                 hidden_size_ilstm: int, K: int, visual_feature_size: int):
+                 hidden_size_ilstm: int, K: int, visual_feature_size: int, checkpoint_interactor: bool = False):
+        """
+        :param checkpoint_interactor: whether to recompute the activations of the iLSTM during the
+        backward pass instead of storing them, which trades compute for memory (training only)
+        """
         super(TGN, self).__init__()
 
         self.word_embed_size = word_embed_size
@@ -19,6 +24,7 @@ class TGN(nn.Module):
         self.hidden_size_textual = hidden_size_textual
         self.hidden_size_ilstm = hidden_size_ilstm
         self.K = K
+        self.checkpoint_interactor = checkpoint_interactor
 
         self.textual_lstm_encoder = TextualLSTMEncoder(embed_size=word_embed_size,
                                                        hidden_size=hidden_size_textual)
@@ -39,24 +45,26 @@ class TGN(nn.Module):
         :param textual_input: a tensor containing a batch of embedded words
         with shape (n_batch, N, max_sentence_length, word_embed_size)
         :param lengths_t: lengths of sentences
-        :returns grounding scores as a tensor with shape (n_batch, T, K)
+        :returns logits of the grounding scores as a tensor with shape (n_batch, T, K)
         """
         lengths_v = [v.shape[0] for v in features_v]
         mask = self._generate_visual_mask(lengths_v)  # used later for computing the loss
 
-        features_v = sorted(features_v, key=lambda v: v.shape[0], reverse=True)
-        lengths_v = sorted(lengths_v, reverse=True)
+        # videos and sentences are kept in the same order, the encoders do not need sorted lengths
         features_v_padded = self._pad_visual_data(features_v)  # shape (n_batch, T, dim_feature)
 
         h_s = self.textual_lstm_encoder(textual_input, lengths_t)  # shape: (n_batch, N, hidden_size_textual)
 
         h_v = self.visual_lstm_encoder(features_v_padded, lengths_v)  # shape: (n_batch, T, hidden_size_visual)
 
-        h_r = self.interactor(h_v, h_s)  # shape: (n_batch, T, hidden_size_ilstm)
+        if self.checkpoint_interactor and torch.is_grad_enabled():
+            h_r = checkpoint(self.interactor, h_v, h_s, use_reentrant=False)  # shape: (n_batch, T, hidden_size_ilstm)
+        else:
+            h_r = self.interactor(h_v, h_s)  # shape: (n_batch, T, hidden_size_ilstm)
 
-        probs = self.grounder(h_r)
+        logits = self.grounder(h_r)
 
-        return probs, mask
+        return logits, mask
 
     def _generate_visual_mask(self, lengths: List[int]):
         """Generate a mask to not consider the padding positions in videos while computing the final loss"""
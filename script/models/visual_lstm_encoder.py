@@ -16,11 +16,12 @@ class VisualLSTMEncoder(nn.Module):
     def forward(self, x: torch.Tensor, lengths: List[int]):
         """
         :param input: A batch of frame features with shape (n_batch, T, feature_size)
-        :param lengths:
+        :param lengths: lengths of the videos (in any order)
         :return: the encoded representation of the frames
         """
         x = x.permute(1, 0, 2)  # shape (T, n_batch, feature_size)
-        x = pack(x, lengths)
+        # the LSTM only runs over the actual frames, the batch order is restored by unpack
+        x = pack(x, lengths, enforce_sorted=False)
         enc_hiddens, (_, _) = self.encoder(x)
         enc_hiddens, _ = unpack(enc_hiddens)  # shape of enc_hiddens is (T, n_batch, hidden_size)
 
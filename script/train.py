@@ -24,48 +24,53 @@ Options:
     --valid-niter=<int>                     perform validation after how many iterations [default: 50]
     --top-n-eval=<int>                      parameter N in R@N, IOU=θ evaluation metric [default: 1]
     --lr-decay=<float>                      learning rate decay [default: 0.5]
+    --amp                                   train with automatic mixed precision on the GPU
+    --num-workers=<int>                     number of processes loading the batches [default: 4]
+    --accum-steps=<int>                     number of batches whose gradients are accumulated per update [default: 1]
+    --distributed                           data-parallel training on all the GPUs of the node, to be launched
+                                            with torch.distributed.launch --use_env
+    --rebuild-stats                         recompute the BCE weights w0 and w1 instead of loading them from .cache
+    --checkpoint-ilstm                      recompute the iLSTM activations in the backward pass to save memory
 """
 
 import torch
-import torch.nn as nn
+import torch.nn.functional as F
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
 from models.tgn import TGN
 from docopt import docopt
 from typing import Dict, List
 from vocab import Vocab
-from utils import load_word_vectors, find_bce_weights, compute_overlap, top_n_iou
+from utils import load_word_vectors, find_bce_weights, compute_overlap, top_n_iou, Prefetcher
 import sys
-from data import TACoS, ActivityNet
+from data import TACoS, ActivityNet, make_data_loader
 from tqdm import tqdm
 from time import time
 from torch.nn.init import xavier_normal_, normal_
 from torch.utils.tensorboard import SummaryWriter
 import numpy as np
-from math import ceil
+import os
+import itertools
+from contextlib import nullcontext
 
 
-def validation(model: TGN, dataset, device, embedding: nn.Embedding, args: Dict):
+def validation(model: TGN, dataset, data_loader: torch.utils.data.DataLoader, device, args: Dict):
     was_training = model.training
 
-    batch_size = int(args['--batch-size'])
-
     with torch.no_grad():
         cum_score = cum_samples = 0
 
-        pbar = tqdm(total=ceil(len(dataset.val_captions) / batch_size))
-
-        for textual_data, visual_data in iter(dataset.data_iter(batch_size, 'val')):
-            cum_samples += len(textual_data)
-            lengths_t = [len(t) for t in textual_data]
-            sents = [t.sent for t in textual_data]
-            textual_data_tensor = vocab.to_input_tensor(sents, device=device)  # tensor with shape (n_batch, N)
-            textual_data_embed_tensor = embedding(textual_data_tensor)  # tensor with shape (n_batch, N, embed_size)
+        pbar = tqdm(total=len(data_loader))
 
-            probs, mask = model(visual_data, textual_data_embed_tensor, lengths_t)  # Tensors with shape (n_batch, T, K)
+        for batch in Prefetcher(data_loader, device):
+            # textual_input is a tensor with shape (n_batch, N, embed_size)
+            textual_input, lengths_t, visual_data, _, gold_start_times, gold_end_times = batch
+            cum_samples += len(lengths_t)
 
-            gold_start_times = [t.start_time for t in textual_data]
-            gold_end_times = [t.end_time for t in textual_data]
+            logits, mask = model(visual_data, textual_input, lengths_t)  # Tensors with shape (n_batch, T, K)
+            probs = torch.sigmoid(logits) * mask
 
-            score = top_n_iou(probs*mask, gold_start_times, gold_end_times, args, dataset.fps, dataset.sample_rate)
+            score = top_n_iou(probs, gold_start_times, gold_end_times, args, dataset.fps, dataset.sample_rate)
             cum_score += score
             pbar.update()
 
@@ -74,10 +79,10 @@ def validation(model: TGN, dataset, device, embedding: nn.Embedding, args: Dict)
     if was_training:
         model.train()
 
-    return cum_score / cum_samples
+    return float(cum_score) / cum_samples
 
 
-def train(dataset, vocab: Vocab, word_vectors: np.ndarray, args: Dict, device):
+def train(dataset, args: Dict, device):
     max_iter = int(args['--max-iter'])
     valid_niter = int(args['--valid-niter'])
     batch_size = int(args['--batch-size'])
@@ -85,15 +90,18 @@ def train(dataset, vocab: Vocab, word_vectors: np.ndarray, args: Dict, device):
     log_every = int(args['--log-every'])
     K = int(args['--K'])
     model_save_path = args['--model-save-path']
+    accum_steps = int(args['--accum-steps'])
+
+    # in distributed training, validation, logging and checkpointing are done by the first process only
+    distributed = args['--distributed']
+    is_main = not distributed or dist.get_rank() == 0
 
-    embedding = nn.Embedding(len(vocab), word_vectors.shape[1], padding_idx=vocab.word2id['<pad>'])
-    embedding.weight = nn.Parameter(data=torch.from_numpy(word_vectors).to(torch.float32), requires_grad=False)
-    
     model = TGN(hidden_size_ilstm=int(args['--hidden-size-ilstm']),
                 hidden_size_textual=int(args['--hidden-size-textual-lstm']),
                 hidden_size_visual=int(args['--hidden-size-visual-lstm']),
-                K=K, word_embed_size=word_vectors.shape[1], 
-                visual_feature_size=dataset.visual_feature_size)
+                K=K, word_embed_size=dataset.word_embed_size, 
+                visual_feature_size=dataset.visual_feature_size,
+                checkpoint_interactor=args['--checkpoint-ilstm'])
 
     model.train()
 
@@ -106,134 +114,217 @@ def train(dataset, vocab: Vocab, word_vectors: np.ndarray, args: Dict, device):
 
 
     model = model.to(device)
-    embedding.to(device)
+
+    # model is still used for validation, saving and loading, the gradients are averaged through ddp_model
+    ddp_model = DistributedDataParallel(model, device_ids=[device.index]) if distributed else model
+
     optimizer = torch.optim.Adam(params=model.parameters(), lr=lr, betas=(0.5, 0.999))
 
-    writer = SummaryWriter()
+    # with mixed precision the GEMMs of the LSTMs run in FP16, the loss is scaled to avoid underflowing gradients
+    use_amp = args['--amp'] and device.type == 'cuda'
+    scaler = torch.cuda.amp.GradScaler(enabled=use_amp)
+
+    writer = SummaryWriter() if is_main else None
+
+    # Tensors with shape (K,). In distributed training only the first process scans the training set,
+    # the other ones wait for it and load the cached weights
+    if is_main:
+        w0, w1 = find_bce_weights(dataset, K, device, rebuild=args['--rebuild-stats'])
+    if distributed:
+        dist.barrier()
+        if not is_main:
+            w0, w1 = find_bce_weights(dataset, K, device)
+    w_diff = w0 - w1
 
-    w0, w1 = find_bce_weights(dataset, K, device)  # Tensors with shape (K,)
+    num_workers = int(args['--num-workers'])
+    train_loader = make_data_loader(dataset, batch_size, 'train', num_workers=num_workers,
+                                    pin_memory=device.type == 'cuda', distributed=distributed)
+    val_loader = make_data_loader(dataset, batch_size, 'val', num_workers=num_workers,
+                                  pin_memory=device.type == 'cuda')
 
     cum_samples = report_samples = 0.
-    report_loss = cum_loss = 0.
+
+    # the losses are accumulated on the device, so that we only wait for the GPU when logging
+    report_loss = torch.zeros([], device=device)
+    cum_loss = torch.zeros([], device=device)
 
     val_scores = []
     patience = num_trial = 0
 
     train_time = begin_time = time()
-    print('begin training...')
-
-    iteration = 0
-    while iteration <= max_iter:
-        for textual_data, visual_features, y in dataset.data_iter(batch_size, 'train'):
-            
-            lengths_t = [len(t) for t in textual_data]
-            textual_data_tensor = vocab.to_input_tensor(textual_data, device=device)  # tensor with shape (n_batch, N)
-            textual_data_embed_tensor = embedding(textual_data_tensor)  # tensor with shape (n_batch, N, embed_size)
-            
-            optimizer.zero_grad()
-            
-            # Computing probs and mask with shape (n_batch, T, K)
-            probs, mask = model(textual_input=textual_data_embed_tensor, features_v=visual_features, lengths_t=lengths_t)
-
-            y = y.to(device)
-                        
-            batch_loss = -torch.sum((w0 * y * torch.log(probs) + w1 * (1 - y) * torch.log(1 - probs)) * mask)
-            batch_loss_val = batch_loss.item()
-
-            cum_samples += len(textual_data)
-            report_samples += len(textual_data)
-            report_loss += batch_loss_val
-            cum_loss += batch_loss_val
-
-            batch_loss.backward()
-            optimizer.step()
-
-            if iteration % log_every == 0:
-                print('iteration number %d, loss: %f, '
-                      'speed %.2f samples/sec, time elapsed %.2f sec' % (iteration,
-                                                                         report_loss / report_samples,
-                                                                         report_samples / (time() - train_time),
-                                                                         time() - begin_time))
-
-                writer.add_scalar('Loss/train', report_loss/report_samples, iteration)
-                report_samples = 0
-                report_loss = 0.
-                train_time = time()
-
-            if iteration % valid_niter == 0:
+    if is_main:
+        print('begin training...')
+
+    optimizer.zero_grad(set_to_none=True)
+
+    def epochs():
+        """Yields a fresh iterator over the training set for every epoch"""
+        for epoch in itertools.count():
+            if distributed:
+                train_loader.sampler.sampler.set_epoch(epoch)
+            yield Prefetcher(train_loader, device)
+
+    # the validation and logging iterations are tracked by counters instead of modulo checks
+    next_log = next_valid = 0
+
+    batches = itertools.chain.from_iterable(epochs())
+    for iteration, batch in enumerate(itertools.islice(batches, max_iter + 1)):
+        # textual_input is a tensor with shape (n_batch, N, embed_size)
+        textual_input, lengths_t, visual_features, y, _, _ = batch
+        is_update_step = (iteration + 1) % accum_steps == 0
+
+        # gradients of the intermediate batches are only accumulated locally, without an all-reduce
+        with ddp_model.no_sync() if distributed and not is_update_step else nullcontext():
+            # Computing logits and mask with shape (n_batch, T, K)
+            with torch.cuda.amp.autocast(enabled=use_amp):
+                logits, mask = ddp_model(textual_input=textual_input, features_v=visual_features,
+                                         lengths_t=lengths_t)
+
+            # since y is binary, w0 * y + w1 * (1 - y) = w1 + y * (w0 - w1) selects the weight of each
+            # term of the loss, it is computed by a single fused kernel and masked in place
+            weights = torch.addcmul(w1.expand_as(y), y, w_diff).mul_(mask)
+            batch_loss = F.binary_cross_entropy_with_logits(logits.float(), y, weight=weights, reduction='sum')
+
+            scaler.scale(batch_loss).backward()
+
+        cum_samples += len(lengths_t)
+        report_samples += len(lengths_t)
+        report_loss += batch_loss.detach()
+        cum_loss += batch_loss.detach()
+
+        if is_update_step:
+            scaler.step(optimizer)
+            scaler.update()
+            optimizer.zero_grad(set_to_none=True)
+
+        if iteration == next_log and is_main:
+            next_log += log_every
+            report_loss_val = report_loss.item()
+            print('iteration number %d, loss: %f, '
+                  'speed %.2f samples/sec, time elapsed %.2f sec' % (iteration,
+                                                                     report_loss_val / report_samples,
+                                                                     report_samples / (time() - train_time),
+                                                                     time() - begin_time))
+
+            writer.add_scalar('Loss/train', report_loss_val / report_samples, iteration)
+            report_samples = 0
+            report_loss.zero_()
+            train_time = time()
+
+        if iteration == next_valid:
+            next_valid += valid_niter
+            if is_main:
                 print('\niteration number %d, cum. loss %.2f, cum. samples %d' % (iteration, 
-                                                                                  cum_loss / cum_samples, 
+                                                                                  cum_loss.item() / cum_samples, 
                                                                                   cum_samples))
 
-                cum_samples = 0
-                cum_loss = 0.
+            cum_samples = 0
+            cum_loss.zero_()
 
+            val_score = 0.
+            if is_main:
                 print('begin Validation...')
-                val_score = validation(model=model, dataset=dataset, device=device, embedding=embedding, args=args)
+                val_score = validation(model=model, dataset=dataset, data_loader=val_loader, device=device,
+                                       args=args)
 
                 print('validation score %f' % val_score)
                 writer.add_scalar('score/val', val_score, iteration)
 
-                is_better = len(val_scores) == 0 or val_score > np.max(val_scores)
-                val_scores.append(val_score)
+            if distributed:
+                # every process takes the same decisions on saving, decaying the learning rate and stopping
+                val_score_t = torch.tensor([val_score], device=device)
+                dist.broadcast(val_score_t, src=0)
+                val_score = val_score_t.item()
 
-                if is_better:
-                    patience = 0
+            is_better = len(val_scores) == 0 or val_score > np.max(val_scores)
+            val_scores.append(val_score)
+
+            if is_better:
+                patience = 0
+                if is_main:
                     print('save currently the best model to [%s]' % model_save_path, file=sys.stderr)
                     model.save(model_save_path)
                     torch.save(optimizer.state_dict(), model_save_path + '.optim')
-                elif patience < int(args['--patience']):
-                    patience += 1
+            elif patience < int(args['--patience']):
+                patience += 1
+                if is_main:
                     print('hit patience %d' % patience, file=sys.stderr)
 
-                    if patience == int(args['--patience']):
-                        num_trial += 1
+                if patience == int(args['--patience']):
+                    num_trial += 1
+                    if is_main:
                         print('hit trial %d' % num_trial, file=sys.stderr)
-                        if num_trial == int(args['--max-num-trial']):
+                    if num_trial == int(args['--max-num-trial']):
+                        if is_main:
                             print('early stop!', file=sys.stderr)
-                            exit(0)
+                        exit(0)
 
-                        lr = optimizer.param_groups[0]['lr'] * float(args['--lr-decay'])
+                    lr = optimizer.param_groups[0]['lr'] * float(args['--lr-decay'])
 
+                    if is_main:
                         print('load previously best model and decay learning rate to %f' % lr, file=sys.stderr)
-                        params = torch.load(model_save_path, map_location=lambda storage, loc: storage)
-                        model.load_state_dict(params['state_dict'])
-                        model = model.to(device)
+                    # loading straight onto the device avoids a CPU copy of the parameters
+                    params = torch.load(model_save_path, map_location=device)
+                    model.load_state_dict(params['state_dict'])
 
+                    if is_main:
                         print('restore parameters of the optimizers', file=sys.stderr)
-                        optimizer.load_state_dict(torch.load(model_save_path + '.optim'))
+                    optimizer.load_state_dict(torch.load(model_save_path + '.optim', map_location=device))
 
-                        # set new learning rate
-                        for param_group in optimizer.param_groups:
-                            param_group['lr'] = lr
+                    # set new learning rate
+                    for param_group in optimizer.param_groups:
+                        param_group['lr'] = lr
 
-                        patience = 0
-            iteration += 1
+                    # drop the gradients accumulated on the discarded weights (when --accum-steps > 1)
+                    optimizer.zero_grad(set_to_none=True)
+
+                    patience = 0
 
     
-    writer.close()
+    if is_main:
+        writer.close()
 
 
 if __name__ == '__main__':
     args = docopt(__doc__)
+
+    if args['--distributed']:
+        dist.init_process_group('nccl')
+        local_rank = int(os.environ['LOCAL_RANK'])
+        torch.cuda.set_device(local_rank)
+        device = torch.device('cuda', local_rank)
+    else:
+        device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+    print('use device: %s' % device, file=sys.stderr)
+
     word_embed_size=50
-    words, word_vectors = load_word_vectors('glove.6B.{}d.txt'.format(word_embed_size))
+    glove_file_path = 'glove.6B.{}d.txt'.format(word_embed_size)
+
+    # in distributed training only the first process builds the cache of the word vectors,
+    # the other ones wait for it and load the cached files
+    is_main = not args['--distributed'] or dist.get_rank() == 0
+    if is_main:
+        words, word_vectors = load_word_vectors(glove_file_path)
+    if args['--distributed']:
+        dist.barrier()
+        if not is_main:
+            words, word_vectors = load_word_vectors(glove_file_path)
 
     vocab = Vocab(words)
     
-    device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
-    print('use device: %s' % device, file=sys.stderr)
     
     if args['tacos']:
         dataset = TACoS(textual_data_path=args['--textual-data-path'], 
                         visual_data_path=args['--visual-data-path'], 
                         K = int(args['--K']), delta = int(args['--delta']), 
-                        threshold = float(args['--threshold']))
+                        threshold = float(args['--threshold']),
+                        vocab=vocab, word_vectors=word_vectors)
     elif args['acnet']:
         dataset = ActivityNet(textual_data_path=args['--textual-data-path'], 
                               visual_data_path=args['--visual-data-path'], 
                               K = int(args['--K']), delta = int(args['--delta']), 
-                              threshold = float(args['--threshold']))
+                              threshold = float(args['--threshold']),
+                              vocab=vocab, word_vectors=word_vectors)
         
-    train(dataset, vocab, word_vectors, args, device)
+    train(dataset, args, device)
         
\ No newline at end of file
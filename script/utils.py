@@ -19,6 +19,7 @@ import os
 import cv2
 import math
 import csv
+import pickle
 from torchvision import transforms
 from matplotlib import pyplot as plt
 from skimage import transform
@@ -29,20 +30,6 @@ import torch.nn as nn
 from models.cnn_encoder import VGG16
 
 
-def pad_textual_data(sents: List[List[str]], pad_token):
-    """ Pad list of sentences according to the longest sentence in the batch.
-    :param sents: list of sentences, where each sentence is represented as a list of words
-    :param pad_token: padding token
-    :returns sents_padded: list of sentences where sentences shorter
-    than the max length sentence are padded out with the pad_token, such that
-    each sentences in the batch now has equal length.
-    """
-    longest = np.max([len(sent) for sent in sents])
-    sents_padded = list(map(lambda sent: sent + [pad_token] * (longest - len(sent)), sents))
-
-    return sents_padded
-
-
 def pad_labels(labels: List[torch.Tensor]):
     """Pad labels according to the label with longest number of time steps (T)
     and concatenates them into a single torch.Tensor
@@ -60,7 +47,93 @@ def pad_labels(labels: List[torch.Tensor]):
     return labels_padded
 
 
+def to_device(batch: Tuple, device: torch.device):
+    """Moves the tensors (and lists of tensors) of a batch to the given device. The copies are
+    non-blocking, so they overlap with computation when the tensors are in pinned memory
+    :param batch: a tuple of tensors, lists of tensors or other objects (e.g. lengths)
+    :param device: device on which to load the tensors
+    :returns the batch with its tensors on the device
+    """
+    def move(x):
+        if isinstance(x, torch.Tensor):
+            return x.to(device, non_blocking=True)
+        if isinstance(x, list) and len(x) > 0 and isinstance(x[0], torch.Tensor):
+            return [v.to(device, non_blocking=True) for v in x]
+        return x
+
+    return tuple(move(x) for x in batch)
+
+
+class Prefetcher(object):
+    """Iterates over the batches one step ahead: while the model works on the current
+    batch, the next one is prepared and copied to the GPU on a side CUDA stream
+    """
+    def __init__(self, batches, device: torch.device):
+        """
+        :param batches: an iterator over batches, e.g. a DataLoader returned by data.make_data_loader
+        :param device: device on which to load the tensors
+        """
+        self.batches = iter(batches)
+        self.device = device
+        self.copy_stream = torch.cuda.Stream(device) if device.type == 'cuda' else None
+        self._stage()
+
+    def _stage(self):
+        """Fetches the next batch and issues its transfer to the device"""
+        try:
+            batch = next(self.batches)
+        except StopIteration:
+            self.staged_batch = None
+            return
+
+        if self.copy_stream is None:
+            self.staged_batch = to_device(batch, self.device)
+        else:
+            with torch.cuda.stream(self.copy_stream):
+                self.staged_batch = to_device(batch, self.device)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.staged_batch is None:
+            raise StopIteration
+
+        batch = self.staged_batch
+
+        if self.copy_stream is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(self.copy_stream)
+
+            # the tensors were allocated on the copy stream but are consumed on the current one
+            for x in batch:
+                for v in (x if isinstance(x, list) else [x]):
+                    if isinstance(v, torch.Tensor):
+                        v.record_stream(current_stream)
+
+        self._stage()
+
+        return batch
+
+
 def load_word_vectors(glove_file_path):
+    """Loads the GloVe word vectors. The text file is parsed only once, the vectors are then
+    cached as a .npy file (memory-mapped by the following runs) next to a pickled list of the words
+    :param glove_file_path: path to the GloVe text file
+    :returns the list of words and the word vectors as a np.ndarray with shape (len(words) + 2, dim),
+    where the first two rows correspond to the pad and the unk tokens
+    """
+    cache_path = os.path.splitext(glove_file_path)[0]
+    vectors_path, words_path = cache_path + '.npy', cache_path + '.words.pkl'
+
+    if os.path.exists(vectors_path) and os.path.exists(words_path):
+        print('Loading cached GloVE word vectors from {}...'.format(vectors_path), file=sys.stderr)
+        with open(words_path, 'rb') as f:
+            words = pickle.load(f)
+        word_vectors = np.load(vectors_path, mmap_mode='r').astype(np.float32, copy=False)
+
+        return words, word_vectors
+
     print('Loading GloVE word vectors from {}...'.format(glove_file_path), file=sys.stderr)
 
     if not os.path.exists('glove.word2vec.txt'):
@@ -69,8 +142,19 @@ def load_word_vectors(glove_file_path):
     model = KeyedVectors.load_word2vec_format('glove.word2vec.txt')
     words = list(model.vocab.keys())
     dim = len(model[words[0]])
-    word_vectors = [np.zeros([2, dim])] + [model[word].reshape(1, -1) for word in words]
-    word_vectors = np.concatenate(word_vectors, axis=0)
+    word_vectors = [np.zeros([2, dim], dtype=np.float32)] + [model[word].reshape(1, -1) for word in words]
+    word_vectors = np.concatenate(word_vectors, axis=0).astype(np.float32, copy=False)
+
+    # the files are written under temporary names and then renamed, so that an interrupted run never
+    # leaves a truncated cache behind. The word list goes last since both files make the cache valid
+    tmp_suffix = '.tmp{}'.format(os.getpid())
+    with open(vectors_path + tmp_suffix, 'wb') as f:
+        np.save(f, word_vectors)
+    os.replace(vectors_path + tmp_suffix, vectors_path)
+
+    with open(words_path + tmp_suffix, 'wb') as f:
+        pickle.dump(words, f)
+    os.replace(words_path + tmp_suffix, words_path)
 
     return words, word_vectors
 
@@ -126,11 +210,16 @@ def extract_visual_features(frames_path: str, features_path: str):
         torch.save(features, out_file)
 
 
-def find_bce_weights(dataset, K: int, device):
+def find_bce_weights(dataset, K: int, device, rebuild: bool = False):
     """Finds the weights w0 and w1 used for computing the cross entropy loss
-    (Please refer to the paper for details)
+    (Please refer to the paper for details). The weights only depend on the labels of the
+    training set, so they are cached in the .cache directory and reused by the following runs
+    :param rebuild: whether to recompute the weights even if they are cached
     """
-    if not os.path.exists('w0_{}_{}.pt'.format(K, dataset.name)):
+    path = os.path.join('.cache', 'bce_weights_{}_K{}_delta{}_threshold{}.pt'.format(dataset.name, K, dataset.delta,
+                                                                                   dataset.threshold))
+
+    if rebuild or not os.path.exists(path):
         print('Calculating BCE weights w0 and w1 for {}...'.format(dataset.name), file=sys.stderr)
         w0 = torch.zeros([K, ], dtype=torch.float32)
 
@@ -144,25 +233,27 @@ def find_bce_weights(dataset, K: int, device):
             tmp = torch.sum(label, dim=0).to(torch.float32)
             w0 += T - tmp
 
-        w0 = (w0 / time_steps).to(device)
-        torch.save(w0, 'w0_{}_{}.pt'.format(K, dataset.name))
-        
-        return w0, 1-w0
+        w0 = w0 / time_steps
+        w1 = 1 - w0
+
+        os.makedirs('.cache', exist_ok=True)
+        torch.save((w0, w1), path)
+
+        return w0.to(device), w1.to(device)
     else:
-        print('Loading BCE weights w0 and w1...', file=sys.stderr)
+        print('Loading BCE weights w0 and w1 from {}...'.format(path), file=sys.stderr)
         
-        w0 = torch.load('w0_{}_{}.pt'.format(K, dataset.name))
-        w0 = w0.to(device)
-        return w0, 1-w0
+        w0, w1 = torch.load(path)
+        return w0.to(device), w1.to(device)
 
 
-def top_n_iou(y_pred: torch.Tensor, gold_start_times: List[int], gold_end_times: List[int], args: Dict,
+def top_n_iou(y_pred: torch.Tensor, gold_start_times: torch.Tensor, gold_end_times: torch.Tensor, args: Dict,
              fps: int, sample_rate: int):
     """Computes R@N, IOU=θ evaluation metric
     :param y_pred: torch.Tensor with shape (n_batch, T, K)
-    :param gold_start_times: ground truth start frames with len (n_batch,)
-    :param gold_end_times: ground truth end frames with len (n_batch,)
-    :returns score: validation score
+    :param gold_start_times: ground truth start times as a torch.Tensor with shape (n_batch,)
+    :param gold_end_times: ground truth end times as a torch.Tensor with shape (n_batch,)
+    :returns score: validation score as a scalar torch.Tensor on the device of y_pred
     """
     n_batch, T, K = y_pred.shape
 
@@ -176,13 +267,13 @@ def top_n_iou(y_pred: torch.Tensor, gold_start_times: List[int], gold_end_times:
     scale_nums = (indices % K) + 1
     start_times = end_times - (scale_nums * delta * sample_rate / fps)
 
-    score = 0
+    # the same overlap as compute_overlap, computed for all the top_n_eval segments of the batch at once
+    gold_start_times = gold_start_times.to(y_pred.device).unsqueeze(dim=1)
+    gold_end_times = gold_end_times.to(y_pred.device).unsqueeze(dim=1)
+    overlaps = torch.clamp(torch.min(end_times, gold_end_times) - torch.max(start_times, gold_start_times), min=0)
 
-    for i in range(n_batch):
-        max_overlap = np.max([compute_overlap(start_time.item(), end_time.item(), gold_start_times[i],
-                                              gold_end_times[i])
-                              for start_time, end_time in zip(start_times[i], end_times[i])])
-        score += int(max_overlap > threshold)
+    max_overlaps, _ = torch.max(overlaps, dim=1)  # tensor with shape (n_batch,)
+    score = torch.sum(max_overlaps > threshold)
 
     return score
 
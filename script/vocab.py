@@ -1,6 +1,5 @@
 from typing import List
-import torch
-from utils import pad_textual_data
+import numpy as np
 import sys
 
 
@@ -71,16 +70,6 @@ class Vocab(object):
         else:
             return self[word]
 
-    def words2indices(self, sents):
-        """Converts list of words or list of sentences of words into list or list of list of indices.
-        :param sents: (list[str] or list[list[str]] sentence(s) in words
-        :return word_ids: (list[int] or list[list[int]]) sentence(s) in indices
-        """
-        if type(sents[0]) == list:
-            return [[self[w] for w in s] for s in sents]
-        else:
-            return [self[w] for w in sents]
-
     def indices2words(self, word_ids: List[int]):
         """Converts list of indices into words.
         :param word_ids: list of word ids
@@ -88,14 +77,10 @@ class Vocab(object):
         """
         return [self.id2word[w_id] for w_id in word_ids]
 
-    def to_input_tensor(self, sents: List[List[str]], device: torch.device) -> torch.Tensor:
-        """Converts list of sentences (words) into tensor with necessary padding for
-        shorter sentences.
-        :param sents: list of sentences (words)
-        :param device: device on which to load the tesnor, i.e. CPU or GPU
-        :returns sents_var: tensor of (batch_size, max_sentence_length)
+    def sent2ids(self, sent: List[str]) -> np.ndarray:
+        """Converts a sentence into an array of indices (used once per caption when loading the datasets).
+        :param sent: list of words
+        :returns word_ids: np.ndarray of indices with dtype np.int64
         """
-        word_ids = self.words2indices(sents)
-        sents_t = pad_textual_data(word_ids, self['<pad>'])
-        sents_var = torch.tensor(sents_t, dtype=torch.long, device=device)
-        return sents_var
+        unk_id = self.word2id['<unk>']
+        return np.fromiter((self.word2id.get(w, unk_id) for w in sent), dtype=np.int64, count=len(sent))